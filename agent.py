@@ -1,17 +1,28 @@
 import streamlit as st
 import google.generativeai as genai
-from fpdf import FPDF
+from google.generativeai import client as genai_client
+from fpdf import FPDF, XPos, YPos
 from docx import Document
-import tempfile
+import io
+import os
+import hashlib
+import json
+import mimetypes
+import asyncio
+import threading
+import base64
+import requests
+import re
+from concurrent.futures import ThreadPoolExecutor
 from streamlit_mermaid import st_mermaid
 
 # --- 1. CONFIGURATION & SETUP ---
 st.set_page_config(page_title="VerbaFlow Team", page_icon="🎙️", layout="wide")
 
-# Custom CSS for that "Standout" UI
-st.markdown("""
+# Custom CSS for that "Standout" UI; base colours live in .streamlit/config.toml.
+# Streamlit drops elements a rerun doesn't emit, so this is still sent each run.
+CUSTOM_CSS = """
 <style>
-    .main { background-color: #0E1117; color: #FAFAFA; }
     h1, h2, h3 { color: #FF4B4B; font-family: 'Helvetica Neue', sans-serif; }
     .stButton>button {
         width: 100%; border-radius: 8px; border: none;
@@ -32,72 +43,232 @@ st.markdown("""
         margin-bottom: 10px; border: 1px solid #333; font-size: 0.9em;
     }
 </style>
-""", unsafe_allow_html=True)
+"""
+st.markdown(CUSTOM_CSS, unsafe_allow_html=True)
 
 # --- 2. THE INTELLIGENT AGENT ---
+TRANSCRIBE_PROMPT = """
+Listen to this audio carefully. It may contain English, Hindi, or Hinglish.
+1. Transcribe it exactly as spoken.
+2. Distinguish between speakers (e.g., 'Speaker 1:', 'Speaker 2:').
+3. If it's a lecture, label the main speaker as 'Lecturer'.
+"""
+
+TASK_PROMPTS = {
+    "Summarize": "Create a comprehensive bullet-point summary",
+    "Elaborate": "Explain the concepts simply for a beginner",
+    "Action Items": "Identify tasks and assignments as a checklist",
+    "Quiz": "Generate 3 quiz questions with answers at the bottom",
+    "Mind Map": (
+        "Create a Mermaid.js flowchart code to visualize connections. "
+        "Start with 'graph TD'. Use short node labels. "
+        "Do NOT use markdown code blocks. Return raw code only"
+    ),
+}
+
+# How each task is labelled in the Knowledge Engine
+TASK_LABELS = {
+    "Summarize": "📝 Summarize",
+    "Elaborate": "🧠 Explain",
+    "Action Items": "✅ Action Items",
+    "Quiz": "❓ Quiz",
+    "Mind Map": "🗺️ Mind Map",
+}
+
+# Chat turns sent back with each question
+HISTORY_TURNS = 3
+
+MERMAID_FENCE = re.compile(r"```(?:mermaid)?")
+
+def clean_result(task, text):
+    # Only mind maps come back as code, so only they need the fences scrubbed
+    if task == "Mind Map":
+        text = MERMAID_FENCE.sub("", text)
+    return text.strip()
+
+def as_markdown(value):
+    """Flattens a JSON value from the model into markdown text."""
+    if isinstance(value, list):
+        return "\n".join(f"- {as_markdown(item)}" for item in value)
+    if isinstance(value, dict):
+        return "\n".join(f"- **{key}**: {as_markdown(item)}" for key, item in value.items())
+    return "" if value is None else str(value)
+
 class TranscriptionAgent:
     def __init__(self, api_key):
-        genai.configure(api_key=api_key)
+        self.api_key = api_key
         # Using the Free Tier capable model
         self.model = genai.GenerativeModel('gemini-flash-latest')
+        generative_client, _ = sdk_clients(api_key)
+        bind_client(self.model, generative_client)
 
-    def listen_and_transcribe(self, audio_file_path):
+    def listen_and_transcribe(self, audio_file):
         """Native hearing with Speaker Identification."""
-        try:
-            audio_file = genai.upload_file(path=audio_file_path)
-            prompt = """
-            Listen to this audio carefully. It may contain English, Hindi, or Hinglish.
-            1. Transcribe it exactly as spoken.
-            2. Distinguish between speakers (e.g., 'Speaker 1:', 'Speaker 2:').
-            3. If it's a lecture, label the main speaker as 'Lecturer'.
-            """
-            response = self.model.generate_content([prompt, audio_file])
-            return response.text
-        except Exception as e:
-            return f"Agent Error: {str(e)}"
+        response = self.model.generate_content([TRANSCRIBE_PROMPT, audio_file])
+        return response.text
+
+    async def transcribe_many(self, audio_file_paths):
+        """Uploads and transcribes several recordings concurrently, in input order."""
+        # Sync SDK calls on worker threads: the SDK's grpc_asyncio client is
+        # bound to the first event loop, which breaks repeated asyncio.run() calls
+        async def one(path):
+            mime_type = mimetypes.guess_type(path)[0] or "audio/wav"
+            audio_file = await asyncio.to_thread(upload_as, self.api_key, path, mime_type)
+            return await asyncio.to_thread(self.listen_and_transcribe, audio_file)
+        return await asyncio.gather(*(one(path) for path in audio_file_paths))
 
     def think_and_process(self, text, task):
-        prompts = {
-            "Summarize": f"Create a comprehensive bullet-point summary:\n\n{text}",
-            "Elaborate": f"Explain the concepts simply for a beginner:\n\n{text}",
-            "Action Items": f"Identify tasks and assignments as a checklist:\n\n{text}",
-            "Quiz": f"Generate 3 quiz questions with answers at the bottom:\n\n{text}",
-            "Mind Map": f"""
-            Create a Mermaid.js flowchart code to visualize connections.
-            - Start with 'graph TD'.
-            - Use short node labels.
-            - Do NOT use markdown code blocks. Return raw code only.
-            Text: {text}
-            """
-        }
-        prompt = prompts.get(task, "Analyze this text.")
+        prompt = f"{TASK_PROMPTS.get(task, 'Analyze this text')}:\n\n{text}"
         response = self.model.generate_content(prompt)
-        return response.text.replace("```mermaid", "").replace("```", "").strip()
+        return clean_result(task, response.text)
 
-    def ask_question(self, transcript, question):
-        prompt = f"Context: {transcript}\n\nQuestion: {question}\n\nAnswer concisely based on context:"
-        response = self.model.generate_content(prompt)
-        return response.text
+    def process_all(self, text, tasks):
+        """Runs several Knowledge-Engine tasks in one request, sending the text once."""
+        instructions = "\n".join(f'- "{task}": {TASK_PROMPTS[task]}.' for task in tasks)
+        prompt = f"""
+        Complete every task below using the text that follows.
+        Return a JSON object whose keys are exactly the task names and whose values are strings.
+        {instructions}
+
+        Text: {text}
+        """
+        response = self.model.generate_content(
+            prompt, generation_config={'response_mime_type': 'application/json'}
+        )
+        data = json.loads(response.text)
+        if not isinstance(data, dict):
+            raise ValueError("Knowledge Engine expected a JSON object keyed by task")
+        results = {}
+        for task in tasks:
+            result = clean_result(task, as_markdown(data.get(task)))
+            # Leave omitted or empty tasks out so they are fetched again next time
+            if result:
+                results[task] = result
+        return results
+
+    def ask_question(self, context, recent_history, question, audio_file=None):
+        """Streams the answer chunk by chunk so the UI can render it as it arrives."""
+        history = "".join(f"Q: {q}\nA: {a}\n" for q, a in recent_history[-HISTORY_TURNS:])
+        prompt = f"Context: {context}\n\n"
+        if history:
+            prompt += f"Recent conversation:\n{history}\n"
+        prompt += f"Question: {question}\n\nAnswer concisely based on context:"
+        # Optionally ground the answer in the already-uploaded recording too
+        contents = [prompt, audio_file] if audio_file else prompt
+        for chunk in self.model.generate_content(contents, stream=True):
+            yield chunk.text
+
+@st.cache_resource(show_spinner=False)
+def sdk_config():
+    """Which key the process-global genai config holds, shared by every session."""
+    return {"api_key": None, "lock": threading.Lock()}
+
+def sdk_clients(api_key):
+    """Returns the (generative, file) clients for `api_key`."""
+    # genai.configure is process-global and rebuilds every client, so only call
+    # it when another session or an earlier run left a different key in effect.
+    # The lock covers the switch and lookup; requests run on the clients outside it.
+    state = sdk_config()
+    with state["lock"]:
+        if state["api_key"] != api_key:
+            genai.configure(api_key=api_key)
+            state["api_key"] = api_key
+        return genai_client.get_default_generative_client(), genai_client.get_default_file_client()
+
+def bind_client(model, client):
+    # google-generativeai 0.8.x: GenerativeModel takes no client argument and binds the
+    # global one lazily on its first request, so set its private `_client` up front
+    model._client = client
+
+def upload_as(api_key, source, mime_type):
+    """Uploads a path or file-like object to the File API under `api_key`."""
+    _, file_client = sdk_clients(api_key)
+    return genai.types.File(file_client.create_file(path=source, mime_type=mime_type))
+
+@st.cache_resource(show_spinner=False)
+def get_agent(api_key):
+    """One agent per API key, reused across reruns."""
+    return TranscriptionAgent(api_key)
+
+# Gemini File handles expire after 48h, so drop ours a little earlier
+@st.cache_resource(show_spinner=False, ttl=47 * 3600)
+def upload_audio(api_key, audio_hash, _audio):
+    """Uploads a recording once per API key; reruns reuse the File handle."""
+    # Stream straight from the in-memory upload, no tempfile round-trip
+    _audio.seek(0)
+    return upload_as(api_key, _audio, _audio.type or "audio/wav")
+
+# Memoized Gemini calls: identical inputs are served from RAM on rerun.
+# `_agent` is skipped by Streamlit's hasher; errors raise, so they are never cached.
+# The cache is process-wide, so bound it rather than keep every user's transcript.
+@st.cache_data(show_spinner=False, max_entries=100, ttl=3600)
+def cached_transcribe(_agent, audio_hash, _audio_file):
+    return _agent.listen_and_transcribe(_audio_file)
+
+@st.cache_data(show_spinner=False, max_entries=100, ttl=3600)
+def cached_process_all(_agent, transcript, tasks):
+    return _agent.process_all(transcript, list(tasks))
+
+@st.cache_data(show_spinner=False, max_entries=100, ttl=3600)
+def render_mermaid_svg(code):
+    """Renders Mermaid code to SVG server-side so reruns show a static image."""
+    encoded = base64.urlsafe_b64encode(code.encode()).decode()
+    response = requests.get(f"https://mermaid.ink/svg/{encoded}", timeout=10)
+    response.raise_for_status()
+    return response.text
+
+@st.cache_resource(show_spinner=False)
+def background_pool():
+    """Worker threads for speculative requests that outlive a single run."""
+    return ThreadPoolExecutor(max_workers=4)
 
 # --- 3. FILE GENERATORS ---
+# Shobhika covers Latin and Devanagari, so English, Hindi and Hinglish all export
+# with one bundled font (SIL OFL 1.1, see fonts/README.md)
+FONT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fonts")
+PDF_FONT = "Shobhika"
+PDF_FONT_FILES = {
+    "": os.path.join(FONT_DIR, "Shobhika-Regular.otf"),
+    "B": os.path.join(FONT_DIR, "Shobhika-Bold.otf"),
+}
+# Symbols Shobhika lacks (arrows, check marks) fall back to DejaVu Sans where installed
+SYMBOL_FONT = "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf"
+
+def load_pdf_font(pdf):
+    """Registers the bundled Unicode font on `pdf`, with shaping for Devanagari."""
+    # Each FPDF gets its own add_font: fpdf2's deepcopy shares the parsed TTFont,
+    # which output() subsets in place, so a cloned template breaks after one export.
+    # create_pdf's cache is what amortizes this parsing instead.
+    for style, path in PDF_FONT_FILES.items():
+        pdf.add_font(PDF_FONT, style, path)
+    if os.path.exists(SYMBOL_FONT):
+        pdf.add_font("DejaVu", "", SYMBOL_FONT)
+        pdf.set_fallback_fonts(["DejaVu"])
+    # Matras and conjuncts need HarfBuzz shaping. Pin the script: guessed from the first
+    # letter, "Lecturer: नमस्ते" would be shaped as Latin. Latin text is unaffected.
+    pdf.set_text_shaping(True, script="deva")
+
+# Font parsing and shaping cost about a second, so repeat downloads of the same notes
+# are served from a small, bounded cache rather than rebuilt
+@st.cache_data(show_spinner=False, max_entries=20, ttl=3600)
 def create_pdf(title, transcript, notes):
     pdf = FPDF()
     pdf.add_page()
-    pdf.set_font("Arial", size=12)
-    def clean(t): return t.encode('latin-1', 'replace').decode('latin-1')
-    pdf.set_font("Arial", 'B', 16)
-    pdf.cell(0, 10, clean(title), ln=True, align='C')
+    load_pdf_font(pdf)
+    family = PDF_FONT
+    pdf.set_font(family, 'B', 16)
+    pdf.cell(0, 10, title, new_x=XPos.LMARGIN, new_y=YPos.NEXT, align='C')
     pdf.ln(10)
-    pdf.set_font("Arial", 'B', 12)
-    pdf.cell(0, 10, "AI Notes:", ln=True)
-    pdf.set_font("Arial", size=11)
-    pdf.multi_cell(0, 10, clean(notes))
+    pdf.set_font(family, 'B', 12)
+    pdf.cell(0, 10, "AI Notes:", new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+    pdf.set_font(family, size=11)
+    pdf.multi_cell(0, 10, notes)
     pdf.ln(10)
-    pdf.set_font("Arial", 'B', 12)
-    pdf.cell(0, 10, "Transcript:", ln=True)
-    pdf.set_font("Arial", size=10)
-    pdf.multi_cell(0, 10, clean(transcript))
-    return pdf.output(dest='S').encode('latin-1')
+    pdf.set_font(family, 'B', 12)
+    pdf.cell(0, 10, "Transcript:", new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+    pdf.set_font(family, size=10)
+    pdf.multi_cell(0, 10, transcript)
+    return bytes(pdf.output())
 
 def create_docx(transcript, notes):
     doc = Document()
@@ -106,11 +277,72 @@ def create_docx(transcript, notes):
     doc.add_paragraph(notes)
     doc.add_heading('Transcript', level=1)
     doc.add_paragraph(transcript)
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".docx") as tmp:
-        doc.save(tmp.name)
-        with open(tmp.name, "rb") as f: return f.read()
+    buf = io.BytesIO()
+    doc.save(buf)
+    return buf.getvalue()
 
 # --- 4. THE UI ---
+def collect_summary(wait=False):
+    """Moves the speculative summary into the results once its request is done."""
+    future = st.session_state.get('summary_future')
+    if future is None or not (wait or future.done()):
+        return
+    del st.session_state['summary_future']
+    try:
+        summary = future.result()
+    except Exception:
+        return  # Only speculative; Generate asks again
+    st.session_state['results'].setdefault("Summarize", summary)
+    # The summary doubles as a compact chat context
+    st.session_state['digest'] = summary
+
+@st.fragment(run_every="1s")
+def await_summary():
+    # Polls while the summary is in flight, then reruns the page to show it
+    future = st.session_state.get('summary_future')
+    if future is None or future.done():
+        st.rerun()
+    st.caption("📝 Summary is on its way...")
+
+def show_result(task, transcript, notes):
+    if task == "Mind Map":
+        try:
+            st.image(render_mermaid_svg(notes), width="stretch")
+        except requests.RequestException:
+            # Offline or mermaid.ink is down: let the browser render it
+            try:
+                st_mermaid(notes, height="400px")
+            except:
+                st.code(notes)
+    else:
+        st.info(notes)
+
+    # Export: files are built only when a download is clicked
+    col_d1, col_d2 = st.columns(2)
+    with col_d1:
+        st.download_button("Download DOCX", lambda: create_docx(transcript, notes), "notes.docx", key=f"docx_{task}")
+    with col_d2:
+        st.download_button("Download PDF", lambda: create_pdf("VerbaFlow", transcript, notes), "notes.pdf", key=f"pdf_{task}")
+
+@st.fragment
+def chat_block(agent, transcript):
+    """Chat UI; as a fragment, asking a question reruns only this block."""
+    st.markdown("---")
+    st.markdown("### 💬 Chat with Audio")
+    user_q = st.text_input("Ask a question about the recording...", key='question')
+    use_audio = 'audio_file' in st.session_state and st.checkbox("Also listen to the original audio")
+    chat = st.session_state.setdefault('chat', [])
+    for q, a in chat:
+        st.markdown(f"<div class='chat-bubble'><b>You:</b> {q}<br><b>Agent:</b> {a}</div>", unsafe_allow_html=True)
+    # The text input keeps its value across reruns, so only ask new questions
+    if user_q and (not chat or chat[-1][0] != user_q):
+        audio_file = st.session_state['audio_file'] if use_audio else None
+        # Send the digest rather than the whole transcript, unless the question quotes it
+        quoted = any(mark in user_q for mark in ('"', '“', '”'))
+        context = transcript if quoted else st.session_state.get('digest', transcript)
+        answer = st.write_stream(agent.ask_question(context, chat, user_q, audio_file))
+        chat.append((user_q, answer))
+
 def main():
     # --- SIDEBAR: TEAM CREDITS ---
     with st.sidebar:
@@ -137,22 +369,35 @@ def main():
         st.warning("👈 Please enter the API Key in the sidebar.")
         return
 
-    agent = TranscriptionAgent(api_key)
+    agent = get_agent(api_key)
 
     # 1. RECORDING
     st.markdown("### 1. Audio Source")
     audio_value = st.audio_input("Record Lecture")
 
     if audio_value:
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".wav") as tmp:
-            tmp.write(audio_value.read())
-            tmp_path = tmp.name
+        # Hash the buffer in place; no copy of the recording is made
+        audio_hash = hashlib.sha256(audio_value.getbuffer()).hexdigest()
 
         if st.button("📝 Transcribe (Identify Speakers)", use_container_width=True):
             with st.spinner("Agent is listening..."):
-                transcript = agent.listen_and_transcribe(tmp_path)
+                try:
+                    audio_file = upload_audio(api_key, audio_hash, audio_value)
+                    st.session_state['audio_file'] = audio_file
+                    transcript = cached_transcribe(agent, audio_hash, audio_file)
+                    # Show the transcript now; summarize its text in the background
+                    # so Summarize is usually ready before it is asked for
+                    st.session_state['summary_future'] = background_pool().submit(agent.think_and_process, transcript, "Summarize")
+                except Exception as e:
+                    transcript = f"Agent Error: {str(e)}"
+                    st.session_state.pop('audio_file', None)
+                    st.session_state.pop('summary_future', None)
+                st.session_state.pop('digest', None)
                 st.session_state['transcript'] = transcript
-                st.rerun()
+                st.session_state['results'] = {}
+                st.session_state['chat'] = []
+                # Clear the old question, or it would be re-sent against the new recording
+                st.session_state['question'] = ""
 
     # 2. TRANSCRIPT & ACTIONS
     if 'transcript' in st.session_state:
@@ -160,44 +405,44 @@ def main():
         st.markdown(f"<div class='agent-box'>{st.session_state['transcript']}</div>", unsafe_allow_html=True)
 
         st.markdown("### 3. Knowledge Engine")
-        c1, c2, c3, c4 = st.columns(4)
-        task = None
-        if c1.button("📝 Summarize"): task = "Summarize"
-        if c2.button("🧠 Explain"): task = "Elaborate"
-        if c3.button("✅ Action Items"): task = "Action Items"
-        if c4.button("🗺️ Mind Map"): task = "Mind Map"
-
-        if task:
-            with st.spinner(f"Agent is generating {task}..."):
-                result = agent.think_and_process(st.session_state['transcript'], task)
-                st.session_state['result'] = result
-                st.session_state['task'] = task
-
-        if 'result' in st.session_state:
-            st.markdown(f"### Result: {st.session_state['task']}")
-            if st.session_state['task'] == "Mind Map":
-                try:
-                    st_mermaid(st.session_state['result'], height="400px")
-                except:
-                    st.code(st.session_state['result'])
-            else:
-                st.info(st.session_state['result'])
-
-            # Export
-            col_d1, col_d2 = st.columns(2)
-            with col_d1:
-                st.download_button("Download DOCX", create_docx(st.session_state['transcript'], st.session_state['result']), "notes.docx")
-            with col_d2:
-                st.download_button("Download PDF", create_pdf("VerbaFlow", st.session_state['transcript'], st.session_state['result']), "notes.pdf")
+        selected = st.multiselect("What would you like?", list(TASK_LABELS), default=["Summarize"], format_func=TASK_LABELS.get)
+        results = st.session_state.setdefault('results', {})
+        generate = st.button("⚡ Generate", disabled=not selected)
+        collect_summary()
+        if generate:
+            # Every selected task that isn't ready yet comes back from one batched call.
+            # A summary already in flight is left out and runs alongside the batch.
+            summary_in_flight = 'summary_future' in st.session_state and "Summarize" in selected
+            missing = tuple(t for t in selected if t not in results and not (summary_in_flight and t == "Summarize"))
+            if missing:
+                with st.spinner("Agent is running the Knowledge Engine..."):
+                    try:
+                        results.update(cached_process_all(agent, st.session_state['transcript'], missing))
+                    except Exception as e:
+                        st.error(f"Agent Error: {str(e)}")
+                    else:
+                        skipped = [TASK_LABELS[t] for t in missing if t not in results]
+                        if skipped:
+                            st.warning(f"No result came back for {', '.join(skipped)}; try Generate again.")
+            if summary_in_flight:
+                with st.spinner("Agent is finishing the summary..."):
+                    collect_summary(wait=True)
+                if "Summarize" not in results:
+                    st.warning("The summary failed; try Generate again.")
+            # Chat grounds on the summary whichever path produced it
+            if "Summarize" in results:
+                st.session_state['digest'] = results["Summarize"]
+        if 'summary_future' in st.session_state:
+            await_summary()
+
+        ready = [t for t in selected if t in results]
+        if ready:
+            for task, tab in zip(ready, st.tabs([TASK_LABELS[t] for t in ready])):
+                with tab:
+                    show_result(task, st.session_state['transcript'], results[task])
 
         # Chat
-        st.markdown("---")
-        st.markdown("### 💬 Chat with Audio")
-        user_q = st.text_input("Ask a question about the recording...")
-        if user_q:
-            with st.spinner("Thinking..."):
-                answer = agent.ask_question(st.session_state['transcript'], user_q)
-                st.markdown(f"<div class='chat-bubble'><b>Agent:</b> {answer}</div>", unsafe_allow_html=True)
+        chat_block(agent, st.session_state['transcript'])
 
 if __name__ == "__main__":
 